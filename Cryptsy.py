@@ -6,27 +6,349 @@ import time
 import hmac
 import hashlib
 import datetime
+import threading
+import gzip
+import urlparse
+import collections
+import math
+import sys
+import weakref
+
+
+class UrllibTransport(object):
+    """ Does the actual HTTP requests and returns the raw response body.
+
+    One instance can be shared by many Api instances (see AccountManager).
+
+    :param opener: Optional urllib2 OpenerDirector to use. Defaults to
+        urllib2.urlopen.
+    """
+    def __init__(self, opener=None):
+        self.opener = opener
+
+    def request(self, url, request_data=None, headers=None):
+        if headers is None:
+            headers = {}
+
+        request = urllib2.Request(url, request_data, headers)
+        if self.opener is None:
+            f = urllib2.urlopen(request)
+        else:
+            f = self.opener.open(request)
+        return f.read()
+
+
+def _replay_key(url, request_data=None):
+    """ Key to match a request against a recorded one. The nonce is left
+    out, because it is different on every run. """
+    if not request_data:
+        return url
+    data = [
+        (k, v) for k, v in urlparse.parse_qsl(request_data) if k != "nonce"
+    ]
+    return "%s?%s" % (url, urllib.urlencode(sorted(data)))
+
+
+class RecordingTransport(object):
+    """ Records all requests and responses of another transport into a gzip
+    compressed log, one json entry per line.
+
+    The signing headers 'Sign' and 'Key' are not written into the log.
+    Every entry is flushed to the file, so a killed process only loses the
+    entry being written.
+
+    :param filename: Log file to write.
+    :param transport: Transport doing the real requests, defaults to a new
+        UrllibTransport.
+    """
+    REDACTED_HEADERS = ("Sign", "Key")
+
+    def __init__(self, filename, transport=None):
+        if transport is None:
+            transport = UrllibTransport()
+        self.transport = transport
+        self._lock = threading.Lock()
+        self._file = gzip.open(filename, "wb")
+        self._start_time = time.time()
+
+    def request(self, url, request_data=None, headers=None):
+        start_time = time.time()
+        body = self.transport.request(url, request_data, headers)
+        duration = time.time() - start_time
+
+        headers = dict(
+            (k, v) for k, v in (headers or {}).items()
+            if k not in self.REDACTED_HEADERS
+        )
+        entry = json.dumps({
+            "url": url,
+            "data": request_data,
+            "headers": headers,
+            "offset": start_time - self._start_time,
+            "duration": duration,
+            "body": body,
+        })
+        with self._lock:
+            self._file.write(entry + "\n")
+            self._file.flush()
+        return body
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_log(filename):
+    """ Yield the entries of a RecordingTransport log. Stops at a truncated
+    end, e.g. of a log of a killed process. """
+    f = gzip.open(filename, "rb")
+    try:
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, EOFError):
+                # missing or broken gzip end
+                return
+            if not line:
+                return
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # last line was only partly written
+                return
+    finally:
+        f.close()
+
+
+class ReplayTransport(object):
+    """ Serves responses recorded by RecordingTransport.
+
+    Requests are matched by url and request data (without the nonce).
+    Responses for the same request are served in recorded order.
+
+    :param filename: Log file written by RecordingTransport.
+    :param realtime: If True, responses are returned with the original
+        timing: every response comes at the same time after the first
+        request as in the recording, but not before the recorded duration
+        of its own request. Otherwise responses are returned as fast as
+        possible.
+    """
+    def __init__(self, filename, realtime=False):
+        self.realtime = realtime
+        self._lock = threading.Lock()
+        self._responses = {}
+
+        # offset of the first recorded request
+        self._first_offset = None
+        # time of the first replayed request
+        self._start_time = None
+
+        for entry in _read_log(filename):
+            key = _replay_key(entry["url"], entry["data"])
+            self._responses.setdefault(key, collections.deque()).append(
+                (entry["offset"], entry["duration"], entry["body"])
+            )
+            if self._first_offset is None or \
+                    entry["offset"] < self._first_offset:
+                self._first_offset = entry["offset"]
+
+    def request(self, url, request_data=None, headers=None):
+        start_time = time.time()
+        key = _replay_key(url, request_data)
+        with self._lock:
+            if self._start_time is None:
+                self._start_time = start_time
+            try:
+                offset, duration, body = self._responses[key].popleft()
+            except (KeyError, IndexError):
+                raise KeyError("No recorded response for %r" % key)
+        if self.realtime:
+            end_time = max(
+                self._start_time + offset - self._first_offset + duration,
+                start_time + duration
+            )
+            wait = end_time - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        return body
+
+
+class PublicCache(object):
+    """ Thread safe cache for public API results, keyed by request url.
+
+    :param ttl: Seconds a cached result stays valid.
+    :param max_entries: Maximum number of cached results, None for no limit.
+        If full, expired results are removed first, then the oldest ones.
+    """
+    def __init__(self, ttl=10, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # notified when a fetch in get_or_fetch() is finished
+        self._fetched = threading.Condition(self._lock)
+        # urls currently fetched in get_or_fetch()
+        self._pending = set()
+        self._data = {}
+
+    def _get(self, url):
+        try:
+            timestamp, result = self._data[url]
+        except KeyError:
+            return None
+        if time.time() - timestamp > self.ttl:
+            del self._data[url]
+            return None
+        return result
+
+    def _set(self, url, result):
+        self._data[url] = (time.time(), result)
+        if self.max_entries is not None and \
+                len(self._data) > self.max_entries:
+            self._sweep()
+            while len(self._data) > self.max_entries:
+                oldest = min(self._data, key=lambda k: self._data[k][0])
+                del self._data[oldest]
+
+    def get(self, url):
+        with self._lock:
+            return self._get(url)
+
+    def set(self, url, result):
+        with self._lock:
+            self._set(url, result)
+
+    def get_or_fetch(self, url, fetch):
+        """ Return the cached result for url, or call fetch() to get it.
+
+        If the same url is already fetched by another thread, wait for its
+        result instead of fetching it again.
+        """
+        with self._lock:
+            while True:
+                result = self._get(url)
+                if result is not None:
+                    return result
+                if url not in self._pending:
+                    break
+                self._fetched.wait()
+            self._pending.add(url)
+
+        try:
+            result = fetch()
+        except Exception:
+            with self._lock:
+                # one of the waiting threads will try again
+                self._pending.discard(url)
+                self._fetched.notify_all()
+            raise
+
+        with self._lock:
+            self._set(url, result)
+            self._pending.discard(url)
+            self._fetched.notify_all()
+        return result
+
+    def _sweep(self):
+        now = time.time()
+        for url, (timestamp, result) in self._data.items():
+            if now - timestamp > self.ttl:
+                del self._data[url]
+
+    def sweep(self):
+        """ Remove all expired results. """
+        with self._lock:
+            self._sweep()
+
+    def memory_usage(self):
+        """ Approximate bytes held by the cached results. """
+        with self._lock:
+            return deep_getsizeof(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RateLimiter(object):
+    """ Token bucket, blocks in acquire() until a request may be done.
+
+    :param rate: Requests per second.
+    :param burst: Maximum number of requests done without waiting.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            wait = (1 - self._tokens) / self.rate
+            self._tokens -= 1
+            if wait > 0:
+                # Sleep while holding the lock, so waiting callers are
+                # served in order.
+                time.sleep(wait)
 
 
 class Api(object):
-    """ API wrapper for the Cryptsy API. """
-    def __init__(self, key, secret):
+    """ API wrapper for the Cryptsy API.
+
+    :param transport: Object with a request(url, request_data, headers)
+        method that returns the raw response body. Defaults to a new
+        UrllibTransport.
+    :param public_cache: Optional PublicCache for public API results.
+    :param rate_limiter: Optional RateLimiter for authenticated requests.
+    """
+    def __init__(self, key, secret, transport=None, public_cache=None,
+                 rate_limiter=None):
         self.API_KEY = key
         self.SECRET = secret
 
+        if transport is None:
+            transport = UrllibTransport()
+        self.transport = transport
+        self.public_cache = public_cache
+        self.rate_limiter = rate_limiter
+
+        # nonces must be increasing per key, even for concurrent calls
+        # within the same millisecond.
+        self._nonce_lock = threading.Lock()
+        self._last_nonce = 0
+        self._auth_lock = threading.Lock()
+
         # set in _public_api_query and _api_query,
         # used for verbose output in high level API
         self.last_api = None
         self.last_method = None
 
+        # Size in bytes of the last raw response body
+        self.last_response_size = None
+
     def _request(self, url, request_data=None, headers=None):
         """ Do a public or authenticated API request """
-        if headers is None:
-            headers = {}
+        body = self.transport.request(url, request_data, headers)
+        self.last_response_size = len(body)
+        return json.loads(body)
 
-        request = urllib2.Request(url, request_data, headers)
-        f = urllib2.urlopen(request)
-        return json.loads(f.read())
+    def _next_nonce(self):
+        """ Return a nonce in milliseconds, always greater than the last. """
+        with self._nonce_lock:
+            nonce = max(int(round(time.time() * 1000)), self._last_nonce + 1)
+            self._last_nonce = nonce
+            return nonce
 
     def _public_api_query(self, method, marketid=None):
         """ Call to the public api and return the loaded json. """
@@ -38,7 +360,14 @@ class Api(object):
         if marketid is not None:
             request_url += '&marketid=%d' % marketid
 
-        return self._request(request_url)
+        if self.public_cache is None:
+            return self._request(request_url)
+
+        # stays None, if the result comes from the cache
+        self.last_response_size = None
+        return self.public_cache.get_or_fetch(
+            request_url, lambda: self._request(request_url)
+        )
 
     def _api_query(self, method, request_data=None):
         """ Call to the "private" api and return the loaded json. """
@@ -49,17 +378,25 @@ class Api(object):
         if request_data is None:
             request_data = {}
         request_data['method'] = method
-        request_data['nonce'] = int(round(time.time() * 1000))
-        post_data = urllib.urlencode(request_data)
-
-        signed_data = hmac.new(self.SECRET, post_data, hashlib.sha512)\
-                          .hexdigest()
-        headers = {
-            'Sign': signed_data,
-            'Key': self.API_KEY
-        }
 
-        return self._request('https://www.cryptsy.com/api', post_data, headers)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        # Cryptsy rejects a nonce lower than the last one it has seen, so
+        # concurrent requests of one key are sent one after another.
+        with self._auth_lock:
+            request_data['nonce'] = self._next_nonce()
+            post_data = urllib.urlencode(request_data)
+
+            signed_data = hmac.new(self.SECRET, post_data, hashlib.sha512)\
+                              .hexdigest()
+            headers = {
+                'Sign': signed_data,
+                'Key': self.API_KEY
+            }
+
+            return self._request('https://www.cryptsy.com/api', post_data,
+                                 headers)
 
     def market_data(self, marketid=None, v2=False):
         """ Get market data for all markets.
@@ -369,6 +706,32 @@ def convert_recursive(v):
     return v
 
 
+def unwrap_result(result):
+    """ Return the "return" value of an Api result. Results of HighLevelApi
+    are returned unchanged. """
+    if isinstance(result, dict) and "return" in result:
+        return result["return"]
+    return result
+
+
+def deep_getsizeof(v, seen=None):
+    """ Approximate memory usage in bytes of v and all containing objects. """
+    if seen is None:
+        seen = set()
+    if id(v) in seen:
+        return 0
+    seen.add(id(v))
+
+    size = sys.getsizeof(v)
+    if isinstance(v, dict):
+        for k, item in v.items():
+            size += deep_getsizeof(k, seen) + deep_getsizeof(item, seen)
+    elif isinstance(v, (list, tuple, set)):
+        for item in v:
+            size += deep_getsizeof(item, seen)
+    return size
+
+
 
 
 def only_non_zero(d):
@@ -401,12 +764,22 @@ class CrypsyAPIError(Exception):
 class HighLevelApi(Api):
     """
     High-Level crypsy API
+
+    Options to bound the memory usage in long running processes:
+
+    :param raw_result_limit: Only keep last_raw_result of responses up to
+        this many bytes. None keeps all, 0 keeps none.
+    :param weak_cache: Hold the cached balance only by a weak reference, so
+        it's freed if no one else uses it.
     """
     def __init__(self, *args, **kwargs):
 
         # Display request information?
         self.verbose = kwargs.pop("verbose", False)
 
+        self.raw_result_limit = kwargs.pop("raw_result_limit", None)
+        self.weak_cache = kwargs.pop("weak_cache", False)
+
         super(HighLevelApi, self).__init__(*args, **kwargs)
 
         # Store the untouched last API result dict
@@ -415,6 +788,48 @@ class HighLevelApi(Api):
         # Stores 'info' result
         self.balance = None
 
+    def _get_balance_cache(self):
+        balance = self._balance
+        # weak_cache may have been changed since the balance was stored
+        if isinstance(balance, weakref.ref):
+            balance = balance()
+        return balance
+
+    def _set_balance_cache(self, balance):
+        if balance is not None and self.weak_cache:
+            balance = weakref.ref(balance)
+        self._balance = balance
+
+    balance = property(_get_balance_cache, _set_balance_cache)
+
+    def memory_usage(self):
+        """
+        Approximate bytes held by this instance's caches.
+
+        :returns: dict with the bytes of 'last_raw_result', 'balance',
+            'public_cache' (may be shared with other instances) and 'total'
+        """
+        usage = {
+            "last_raw_result": 0,
+            "balance": 0,
+            "public_cache": 0,
+        }
+        if self.last_raw_result is not None:
+            usage["last_raw_result"] = deep_getsizeof(self.last_raw_result)
+        balance = self.balance
+        if balance is not None:
+            usage["balance"] = deep_getsizeof(balance)
+        if self.public_cache is not None:
+            usage["public_cache"] = self.public_cache.memory_usage()
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def _public_api_query(self, method, marketid=None):
+        # A cached result doesn't call _request(), so last_raw_result would
+        # still be the result of the previous request.
+        self.last_raw_result = None
+        return super(HighLevelApi, self)._public_api_query(method, marketid)
+
     def _request(self, url, request_data=None, headers=None):
         if self.verbose:
             print "Request %r method %r..." % (
@@ -423,7 +838,11 @@ class HighLevelApi(Api):
             start_time = time.time()
 
         result = super(HighLevelApi, self)._request(url, request_data, headers)
-        self.last_raw_result = result.copy()
+        if self.raw_result_limit is None or \
+                self.last_response_size <= self.raw_result_limit:
+            self.last_raw_result = result.copy()
+        else:
+            self.last_raw_result = None
         if self.verbose:
             print "OK (response in %.2fsec)" % (time.time() - start_time)
 
@@ -442,9 +861,12 @@ class HighLevelApi(Api):
         """
         Cached access to account balance
         """
-        if self.balance is None:
-            self.balance = AccountBalance(self)
-        return self.balance
+        balance = self.balance
+        if balance is None:
+            # keep a strong reference, self.balance may be only a weak one
+            balance = AccountBalance(self)
+            self.balance = balance
+        return balance
 
     def single_market_data(self, marketid):
         result = super(HighLevelApi, self).single_market_data(marketid)
@@ -453,6 +875,473 @@ class HighLevelApi(Api):
         return result
 
 
+#------------------------------------------------------------------------------
+
+
+class AccountManager(object):
+    """
+    Manage several accounts with one shared transport and public data cache.
+
+    Every account gets its own Api instance, so nonces and the rate limit
+    bucket stay per key.
+
+    :param accounts: dict of account name -> (key, secret)
+    :param api_class: Api class to use, e.g. HighLevelApi
+    :param transport: Shared transport, defaults to a new UrllibTransport.
+    :param public_cache_ttl: Seconds to cache public API results, None to
+        disable the shared cache.
+    :param public_cache_max_entries: Maximum number of cached public API
+        results, None for no limit.
+    :param rate: Authenticated requests per second per account, None for no
+        limit.
+    :param burst: Burst size of the per account rate limit.
+    """
+    def __init__(self, accounts=None, api_class=Api, transport=None,
+                 public_cache_ttl=10, public_cache_max_entries=None,
+                 rate=None, burst=1, **api_kwargs):
+        self.api_class = api_class
+        if transport is None:
+            transport = UrllibTransport()
+        self.transport = transport
+        if public_cache_ttl is None:
+            self.public_cache = None
+        else:
+            self.public_cache = PublicCache(
+                public_cache_ttl, public_cache_max_entries
+            )
+        self.rate = rate
+        self.burst = burst
+        self.api_kwargs = api_kwargs
+
+        self.accounts = {}
+        if accounts is not None:
+            for name, (key, secret) in accounts.items():
+                self.add_account(name, key, secret)
+
+    def add_account(self, name, key, secret):
+        if self.rate is None:
+            rate_limiter = None
+        else:
+            rate_limiter = RateLimiter(self.rate, self.burst)
+
+        api = self.api_class(
+            key, secret,
+            transport=self.transport,
+            public_cache=self.public_cache,
+            rate_limiter=rate_limiter,
+            **self.api_kwargs
+        )
+        self.accounts[name] = api
+        return api
+
+    def __getitem__(self, name):
+        return self.accounts[name]
+
+    def fan_out(self, method, *args, **kwargs):
+        """ Call a method on all accounts concurrently.
+
+        e.g.: results, errors = manager.fan_out("cancel_all_orders")
+
+        :returns: Two dicts: account name -> result and
+            account name -> raised exception
+        """
+        results = {}
+        errors = {}
+
+        def worker(name, api):
+            try:
+                results[name] = getattr(api, method)(*args, **kwargs)
+            except Exception as err:
+                errors[name] = err
+
+        threads = [
+            threading.Thread(target=worker, args=(name, api))
+            for name, api in self.accounts.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+
+#------------------------------------------------------------------------------
+
+
+class FeeModel(object):
+    """
+    Local fee calculation, learned from a few calculate_fees() responses.
+
+    The fee is a percentage of the order total. The rate (and if the fee is
+    added to or subtracted from the total) is learned per order type, so
+    whole batches of candidate orders can be calculated without API calls.
+    The schedule is checked against the API again every check_interval
+    seconds. Order types with a changed schedule are collected in the
+    changed set, which the caller may read and clear.
+
+    :param api: Api or HighLevelApi instance
+    :param check_interval: Seconds between checks against the API, None to
+        never check again.
+    :param tolerance: Allowed difference of the rate before it counts as
+        changed. Defaults to the precision of the observed fee, which the API
+        rounds to 8 decimals.
+    """
+    # Order total used by learn(). A large total gives the most precise
+    # rate, because the API rounds fees to 8 decimals.
+    PROBE_QUANTITY = 1000000
+    PROBE_PRICE = 1
+
+    def __init__(self, api, check_interval=600, tolerance=None):
+        self.api = api
+        self.check_interval = check_interval
+        self.tolerance = tolerance
+
+        # ordertype -> (rate, sign of the fee in the net total)
+        self.schedule = {}
+        # ordertype -> order total the rate was learned from
+        self._totals = {}
+        self.last_check = None
+        # order types with a detected schedule change
+        self.changed = set()
+
+    def observe(self, ordertype, quantity, price, result):
+        """ Learn from a calculate_fees() result.
+
+        The learned rate is only replaced by a rate of an order with a
+        smaller total (so less precise rate) if the schedule changed.
+
+        :returns: True if the schedule of this ordertype changed.
+        """
+        result = unwrap_result(result)
+        fee = float(result["fee"])
+        net = float(result["net"])
+        total = float(quantity) * float(price)
+        if total <= 0:
+            raise ValueError("Can't learn fees from an order total of %r" % (
+                total
+            ))
+
+        rate = fee / total
+        if net < total:
+            sign = -1
+        else:
+            sign = 1
+
+        old = self.schedule.get(ordertype)
+        old_total = self._totals.get(ordertype)
+        if old is None:
+            changed = False
+        else:
+            tolerance = self.tolerance
+            if tolerance is None:
+                # both rates may be off by half of the last fee decimal
+                tolerance = 1e-8 / min(total, old_total)
+            changed = abs(old[0] - rate) > tolerance or old[1] != sign
+
+        if old is None or changed or total >= old_total:
+            self.schedule[ordertype] = (rate, sign)
+            self._totals[ordertype] = total
+        if changed:
+            self.changed.add(ordertype)
+        return changed
+
+    def learn(self, ordertype, quantity=None, price=None):
+        """ Learn the fee schedule of ordertype from one API request.
+
+        Defaults to the order total PROBE_QUANTITY * PROBE_PRICE.
+        """
+        if quantity is None:
+            quantity = self.PROBE_QUANTITY
+        if price is None:
+            price = self.PROBE_PRICE
+        result = self.api.calculate_fees(ordertype, quantity, price)
+        self.last_check = time.time()
+        return self.observe(ordertype, quantity, price, result)
+
+    def check(self):
+        """ Learn all known order types again.
+
+        Changed order types are added to the changed set, too.
+
+        :returns: set of order types with a changed schedule
+        """
+        changed = set()
+        for ordertype in list(self.schedule):
+            if self.learn(ordertype):
+                changed.add(ordertype)
+        return changed
+
+    def _check_due(self):
+        return self.check_interval is not None and \
+            self.last_check is not None and \
+            time.time() - self.last_check > self.check_interval
+
+    def fees(self, ordertype, quantities, prices):
+        """ Calculate fees for a batch of candidate orders.
+
+        :param quantities: Sequence of quantities
+        :param prices: Sequence of prices, same length as quantities
+        :returns: list of (fee, net) tuples, like calculate_fees()
+        """
+        if ordertype not in self.schedule:
+            self.learn(ordertype)
+        elif self._check_due():
+            self.check()
+
+        rate, sign = self.schedule[ordertype]
+        result = []
+        for quantity, price in zip(quantities, prices):
+            total = quantity * price
+            fee = round(total * rate, 8)
+            result.append((fee, round(total + sign * fee, 8)))
+        return result
+
+    def fee(self, ordertype, quantity, price):
+        """ Calculate fee and net total for one order. """
+        return self.fees(ordertype, [quantity], [price])[0]
+
+
+#------------------------------------------------------------------------------
+
+
+class CurrencyGraph(object):
+    """
+    Index of all markets as a currency conversion graph, for arbitrage and
+    multi-hop path searches.
+
+    Build it once from the markets() result and update the prices on every
+    tick. Only the edges of changed markets are touched, and
+    triangle_opportunities() only looks at the triangles through them.
+
+    Every market PRIMARY/SECONDARY has two edges: PRIMARY -> SECONDARY
+    (sell at the bid) and SECONDARY -> PRIMARY (buy at the ask).
+
+    :param markets: Result of Api.markets() or HighLevelApi.markets()
+    :param fee: Fee fraction charged per trade, e.g. 0.002
+    """
+    def __init__(self, markets, fee=0):
+        self.fee = fee
+
+        # marketid -> (primary code, secondary code)
+        self.markets = {}
+        # currency -> set of currencies it can be converted to
+        self.adjacency = collections.defaultdict(set)
+        # (from, to) -> rate and -log(rate), only for edges with a price
+        self.rates = {}
+        self.weights = {}
+
+        markets = unwrap_result(markets)
+        for market in markets:
+            primary = market["primary_currency_code"]
+            secondary = market["secondary_currency_code"]
+            self.markets[int(market["marketid"])] = (primary, secondary)
+            self.adjacency[primary].add(secondary)
+            self.adjacency[secondary].add(primary)
+
+        self._edge_markets = {}
+        for marketid, (primary, secondary) in self.markets.items():
+            self._edge_markets[(primary, secondary)] = marketid
+            self._edge_markets[(secondary, primary)] = marketid
+
+        self._triangles = self._build_triangles()
+        self.changed = set()
+
+    def _build_triangles(self):
+        """ marketid -> set of all conversion triangles through it """
+        triangles = collections.defaultdict(set)
+        for a in self.adjacency:
+            for b in self.adjacency[a]:
+                for c in self.adjacency[b]:
+                    if c == a or a not in self.adjacency[c]:
+                        continue
+                    cycle = (a, b, c)
+                    # the same cycle in all rotations is stored only once
+                    i = cycle.index(min(cycle))
+                    cycle = cycle[i:] + cycle[:i]
+                    for edge in ((a, b), (b, c), (c, a)):
+                        triangles[self._edge_markets[edge]].add(cycle)
+        return triangles
+
+    def _set_rate(self, edge, rate):
+        self.rates[edge] = rate
+        self.weights[edge] = -math.log(rate)
+
+    def update_market(self, marketid, bid, ask=None):
+        """ Update the edges of one market.
+
+        A price <= 0 (e.g. empty order book) removes both edges.
+
+        :param bid: Price to sell the primary currency at.
+        :param ask: Price to buy the primary currency at, defaults to bid.
+        :returns: True if the prices changed.
+        """
+        marketid = int(marketid)
+        if ask is None:
+            ask = bid
+        bid, ask = float(bid), float(ask)
+        primary, secondary = self.markets[marketid]
+
+        if bid <= 0 or ask <= 0:
+            if (primary, secondary) not in self.rates:
+                return False
+            for edge in ((primary, secondary), (secondary, primary)):
+                del self.rates[edge]
+                del self.weights[edge]
+            self.changed.add(marketid)
+            return True
+
+        sell_rate = bid * (1 - self.fee)
+        buy_rate = (1 / ask) * (1 - self.fee)
+        if self.rates.get((primary, secondary)) == sell_rate and \
+                self.rates.get((secondary, primary)) == buy_rate:
+            return False
+
+        self._set_rate((primary, secondary), sell_rate)
+        self._set_rate((secondary, primary), buy_rate)
+        self.changed.add(marketid)
+        return True
+
+    def update_from_market_data(self, market_data):
+        """ Update all prices from a Api or HighLevelApi
+        market_data(v2=True) result.
+
+        Uses the best buy and sell order if available, otherwise the last
+        trade price. Markets without any price are skipped.
+
+        :returns: set of changed marketids
+        """
+        market_data = unwrap_result(market_data)
+
+        changed = set()
+        for data in market_data["markets"].values():
+            marketid = int(data["marketid"])
+            if marketid not in self.markets:
+                continue
+
+            bid = ask = data["lasttradeprice"]
+            if data.get("buyorders"):
+                bid = data["buyorders"][0]["price"]
+            if data.get("sellorders"):
+                ask = data["sellorders"][0]["price"]
+            if bid is None or ask is None:
+                # never traded and no orders
+                continue
+
+            if self.update_market(marketid, bid, ask):
+                changed.add(marketid)
+        return changed
+
+    def cycle_rate(self, cycle):
+        """ Conversion rate of a cycle, > 1 means profit. None if a price is
+        missing. """
+        rate = 1.0
+        for i, currency in enumerate(cycle):
+            edge = (currency, cycle[(i + 1) % len(cycle)])
+            if edge not in self.rates:
+                return None
+            rate *= self.rates[edge]
+        return rate
+
+    def triangle_opportunities(self, marketids=None, min_rate=1.0):
+        """ Find profitable triangles through the given markets.
+
+        :param marketids: Markets to check, defaults to all markets changed
+            since the last call.
+        :returns: list of (rate, cycle) tuples, best first.
+        """
+        if marketids is None:
+            marketids = self.changed
+            self.changed = set()
+
+        cycles = set()
+        for marketid in marketids:
+            cycles.update(self._triangles.get(marketid, ()))
+
+        result = []
+        for cycle in cycles:
+            rate = self.cycle_rate(cycle)
+            if rate is not None and rate > min_rate:
+                result.append((rate, cycle))
+        result.sort(reverse=True)
+        return result
+
+    def best_path(self, source, target, max_hops=3):
+        """ Best conversion path with at most max_hops trades
+        (Bellman-Ford on -log(rate)).
+
+        No currency is visited twice, except the target if it is the
+        source. A path with more trades is only used if its rate is better
+        by more than the rounding noise.
+
+        :returns: (rate, path) or None if target is not reachable.
+        """
+        # currency -> (-log(rate), path) of the best path with hops trades
+        paths = {source: (0.0, (source,))}
+        best = None
+        for hops in range(max_hops):
+            new_paths = {}
+            for node, (dist, path) in paths.items():
+                if node == target and len(path) > 1:
+                    # paths are not extended beyond the target
+                    continue
+                for neighbour in self.adjacency.get(node, ()):
+                    if neighbour in path and neighbour != target:
+                        continue
+                    weight = self.weights.get((node, neighbour))
+                    if weight is None:
+                        continue
+                    if neighbour not in new_paths or \
+                            dist + weight < new_paths[neighbour][0]:
+                        new_paths[neighbour] = (
+                            dist + weight, path + (neighbour,)
+                        )
+            paths = new_paths
+
+            if target in paths and \
+                    (best is None or paths[target][0] < best[0] - 1e-12):
+                best = paths[target]
+
+        if best is None:
+            return None
+
+        weight, path = best
+        return math.exp(-weight), list(path)
+
+    def find_arbitrage(self):
+        """ Search a negative cycle in the whole graph (Bellman-Ford).
+
+        :returns: list of currencies of a profitable cycle, or None
+        """
+        if not self.weights:
+            return None
+
+        nodes = list(self.adjacency)
+        distance = dict((node, 0.0) for node in nodes)
+        predecessor = {}
+        changed_node = None
+        for _ in range(len(nodes)):
+            changed_node = None
+            for (a, b), weight in self.weights.items():
+                if distance[a] + weight < distance[b] - 1e-12:
+                    distance[b] = distance[a] + weight
+                    predecessor[b] = a
+                    changed_node = b
+            if changed_node is None:
+                return None
+
+        # walk back far enough to be inside the cycle
+        node = changed_node
+        for _ in range(len(nodes)):
+            node = predecessor[node]
+        cycle = [node]
+        current = predecessor[node]
+        while current != node:
+            cycle.append(current)
+            current = predecessor[current]
+        cycle.reverse()
+        return cycle
+
+
 
 
 if __name__ == "__main__":
@@ -1,9 +1,16 @@
+import gzip
+import json
 import pytest
+import threading
+import time
 import urllib2
+import urlparse
 
 from mock import Mock
 
-from Cryptsy import Api
+from Cryptsy import Api, HighLevelApi, AccountBalance, AccountManager, \
+    PublicCache, RateLimiter, RecordingTransport, ReplayTransport, \
+    CurrencyGraph, FeeModel
 
 
 @pytest.fixture
@@ -270,3 +277,516 @@ def test_make_withdrawal(api, api_query_mock):
                                           'address': 'address',
                                           'amount': 100
                                       })
+
+
+def test_nonce_is_increasing(api):
+    """ Nonces must be unique per key, even within the same millisecond. """
+    nonces = [api._next_nonce() for _ in range(100)]
+    assert nonces == sorted(set(nonces))
+
+
+def test_concurrent_nonces_are_sent_in_order():
+    """ Concurrent requests of one key must reach the transport with
+    increasing nonces. """
+    nonces = []
+
+    def request(url, request_data=None, headers=None):
+        nonces.append(int(urlparse.parse_qs(request_data)['nonce'][0]))
+        return '{"success": 1}'
+
+    transport = Mock()
+    transport.request = Mock(side_effect=request)
+    api = Api('KEY', 'SECRET', transport=transport,
+              rate_limiter=RateLimiter(200, 1))
+
+    def worker():
+        for _ in range(5):
+            api.info()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(nonces) == 40
+    assert nonces == sorted(set(nonces))
+
+
+def test_public_cache(mock_urlopen):
+    """ A cached public result should not be requested again. """
+    cache = PublicCache(ttl=60)
+    api = Api('KEY', 'SECRET', public_cache=cache)
+    rv = api._public_api_query('testmethod')
+    api.transport = Mock()
+    assert api._public_api_query('testmethod') is rv
+    assert not api.transport.request.called
+
+
+def test_public_cache_ttl():
+    cache = PublicCache(ttl=-1)
+    cache.set('url', 'result')
+    assert cache.get('url') is None
+
+
+def test_public_cache_max_entries():
+    """ Expired results are removed first, then the oldest ones. """
+    cache = PublicCache(ttl=60, max_entries=2)
+    cache.set('old', 'result')
+    cache._data['old'] = (time.time() - 10, 'result')
+    cache.set('expired', 'result')
+    cache._data['expired'] = (time.time() - 61, 'result')
+    cache.set('new', 'result')
+    assert sorted(cache._data) == ['new', 'old']
+
+    cache.set('newest', 'result')
+    assert sorted(cache._data) == ['new', 'newest']
+
+
+def test_public_cache_sweep_and_memory_usage():
+    cache = PublicCache(ttl=60)
+    assert cache.memory_usage() > 0
+    empty_size = cache.memory_usage()
+    cache.set('url', {'price': '0.025'})
+    assert cache.memory_usage() > empty_size
+
+    cache._data['url'] = (time.time() - 61, 'result')
+    cache.sweep()
+    assert cache._data == {}
+
+
+def test_rate_limiter_burst():
+    """ Requests within the burst size should not wait. """
+    limiter = RateLimiter(rate=1000, burst=5)
+    for _ in range(5):
+        limiter.acquire()
+    assert limiter._tokens < 1
+
+
+@pytest.fixture
+def manager():
+    transport = Mock()
+    transport.request.return_value = '{"success": 1}'
+    return AccountManager({
+        'one': ('KEY1', 'SECRET1'),
+        'two': ('KEY2', 'SECRET2'),
+    }, transport=transport)
+
+
+def test_account_manager_shares_transport_and_cache(manager):
+    one, two = manager['one'], manager['two']
+    assert one.transport is two.transport is manager.transport
+    assert one.public_cache is two.public_cache is manager.public_cache
+
+    one.market_data(v2=True)
+    two.market_data(v2=True)
+    assert manager.transport.request.call_count == 1
+
+
+def test_account_manager_fan_out_fetches_public_data_once():
+    """ Concurrent requests of the same public data are combined. """
+    def request(url, request_data=None, headers=None):
+        time.sleep(0.05)
+        return '{"success": 1}'
+
+    transport = Mock()
+    transport.request = Mock(side_effect=request)
+    manager = AccountManager(dict(
+        (str(i), ('KEY%i' % i, 'SECRET%i' % i)) for i in range(5)
+    ), transport=transport)
+
+    results, errors = manager.fan_out('market_data', v2=True)
+    assert errors == {}
+    assert len(results) == 5
+    assert transport.request.call_count == 1
+
+
+def test_public_cache_fetch_error():
+    """ If a fetch fails, the next caller fetches again. """
+    cache = PublicCache(ttl=60)
+    with pytest.raises(ValueError):
+        cache.get_or_fetch('url', Mock(side_effect=ValueError))
+    assert cache.get_or_fetch('url', lambda: 'result') == 'result'
+    assert cache.get('url') == 'result'
+
+
+def test_account_manager_per_key_rate_limiter():
+    manager = AccountManager({
+        'one': ('KEY1', 'SECRET1'),
+        'two': ('KEY2', 'SECRET2'),
+    }, transport=Mock(), rate=2)
+    assert manager['one'].rate_limiter is not manager['two'].rate_limiter
+
+
+def test_account_manager_fan_out(manager):
+    manager['two'].info = Mock(side_effect=ValueError('boom'))
+    results, errors = manager.fan_out('info')
+    assert results == {'one': {'success': 1}}
+    assert list(errors.keys()) == ['two']
+    assert isinstance(errors['two'], ValueError)
+
+
+def test_record_and_replay(tmpdir):
+    """ Recorded responses should be served back, without the signing
+    headers in the log. """
+    filename = str(tmpdir.join("traffic.log.gz"))
+    transport = Mock()
+    transport.request.return_value = '{"success": 1, "return": "info"}'
+    recording = RecordingTransport(filename, transport=transport)
+    api = Api('KEY', 'SECRET', transport=recording)
+    assert api.info() == {"success": 1, "return": "info"}
+    recording.close()
+
+    with gzip.open(filename, "rb") as f:
+        log = f.read()
+    assert "SECRET" not in log
+    assert "Sign" not in log
+
+    api = Api('KEY', 'SECRET', transport=ReplayTransport(filename))
+    assert api.info() == {"success": 1, "return": "info"}
+    with pytest.raises(KeyError):
+        api.info()
+
+
+def test_replay_unclosed_recording(tmpdir):
+    """ Entries of a recording that was never closed (killed process) are
+    on disk and can be replayed. """
+    filename = str(tmpdir.join("traffic.log.gz"))
+    transport = Mock()
+    transport.request.return_value = '{"success": 1}'
+    recording = RecordingTransport(filename, transport=transport)
+    for i in range(50):
+        recording.request("http://example.com/%i" % i)
+
+    replay = ReplayTransport(filename)
+    for i in range(50):
+        assert replay.request("http://example.com/%i" % i) == '{"success": 1}'
+    recording.close()
+
+
+def test_replay_truncated_recording(tmpdir):
+    filename = str(tmpdir.join("traffic.log.gz"))
+    transport = Mock()
+    transport.request.return_value = \
+        '{"success": 1, "data": "%s"}' % ("x" * 500)
+    with RecordingTransport(filename, transport=transport) as recording:
+        for i in range(50):
+            recording.request("http://example.com/%i" % i)
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    with open(filename, "wb") as f:
+        f.write(data[:len(data) // 2])
+
+    replay = ReplayTransport(filename)
+    assert replay.request("http://example.com/0") == \
+        transport.request.return_value
+    with pytest.raises(KeyError):
+        replay.request("http://example.com/49")
+
+
+def test_replay_realtime(tmpdir):
+    """ Realtime replay should keep the recorded gaps between requests. """
+    filename = str(tmpdir.join("traffic.log.gz"))
+    with gzip.open(filename, "wb") as f:
+        for offset in (1.0, 1.2):
+            f.write(json.dumps({
+                "url": "http://example.com/", "data": None, "headers": {},
+                "offset": offset, "duration": 0.05, "body": "{}",
+            }) + "\n")
+
+    transport = ReplayTransport(filename, realtime=True)
+    start_time = time.time()
+    transport.request("http://example.com/")
+    assert 0.05 <= time.time() - start_time < 0.2
+    transport.request("http://example.com/")
+    assert 0.25 <= time.time() - start_time < 0.4
+
+    transport = ReplayTransport(filename)
+    start_time = time.time()
+    transport.request("http://example.com/")
+    transport.request("http://example.com/")
+    assert time.time() - start_time < 0.05
+
+
+@pytest.fixture
+def currency_graph():
+    return CurrencyGraph([
+        {"marketid": "1", "primary_currency_code": "LTC",
+         "secondary_currency_code": "BTC"},
+        {"marketid": "2", "primary_currency_code": "DOGE",
+         "secondary_currency_code": "BTC"},
+        {"marketid": "3", "primary_currency_code": "DOGE",
+         "secondary_currency_code": "LTC"},
+        {"marketid": "4", "primary_currency_code": "XPM",
+         "secondary_currency_code": "BTC"},
+    ])
+
+
+def test_currency_graph_update_from_market_data(currency_graph):
+    changed = currency_graph.update_from_market_data({"markets": {
+        "LTC/BTC": {"marketid": "1", "lasttradeprice": "0.025",
+                    "buyorders": [{"price": "0.024"}],
+                    "sellorders": [{"price": "0.026"}]},
+        "FOO/BTC": {"marketid": "99", "lasttradeprice": "1"},
+    }})
+    assert changed == set([1])
+    assert currency_graph.rates[("LTC", "BTC")] == 0.024
+    assert currency_graph.rates[("BTC", "LTC")] == 1 / 0.026
+
+    # unchanged prices don't mark the market as changed again
+    assert not currency_graph.update_market(1, "0.024", "0.026")
+
+    # markets without any price are skipped
+    assert currency_graph.update_from_market_data({"markets": {
+        "DOGE/BTC": {"marketid": "2", "lasttradeprice": None,
+                     "buyorders": None, "sellorders": None},
+    }}) == set()
+
+
+def test_currency_graph_dead_market(currency_graph):
+    """ A market without price must not keep its old rates. """
+    currency_graph.update_market(1, 0.025)
+    currency_graph.update_market(2, 0.000001)
+    currency_graph.update_market(3, 0.00005)
+    assert currency_graph.find_arbitrage() is not None
+    currency_graph.triangle_opportunities()
+
+    assert currency_graph.update_market(3, 0)
+    assert ("DOGE", "LTC") not in currency_graph.rates
+    assert ("LTC", "DOGE") not in currency_graph.weights
+    assert currency_graph.changed == set([3])
+    assert currency_graph.triangle_opportunities() == []
+    assert currency_graph.find_arbitrage() is None
+    assert not currency_graph.update_market(3, 0)
+
+
+def test_currency_graph_api_results():
+    """ Results of the low level Api contain the "return" envelope. """
+    currency_graph = CurrencyGraph({"success": "1", "return": [
+        {"marketid": "1", "primary_currency_code": "LTC",
+         "secondary_currency_code": "BTC"},
+    ]})
+    changed = currency_graph.update_from_market_data({
+        "success": 1,
+        "return": {"markets": {
+            "LTC/BTC": {"marketid": "1", "lasttradeprice": "0.025"},
+        }},
+    })
+    assert changed == set([1])
+    assert currency_graph.rates[("LTC", "BTC")] == 0.025
+
+
+def test_currency_graph_triangles(currency_graph):
+    currency_graph.update_market(1, 0.025)
+    currency_graph.update_market(2, 0.000001)
+    currency_graph.update_market(3, 0.00005)
+
+    opportunities = currency_graph.triangle_opportunities()
+    assert len(opportunities) == 1
+    rate, cycle = opportunities[0]
+    assert round(rate, 6) == 1.25
+    assert currency_graph.cycle_rate(cycle) == rate
+
+    # nothing changed since the last call
+    assert currency_graph.triangle_opportunities() == []
+    # XPM/BTC is in no triangle
+    currency_graph.update_market(4, 0.0001)
+    assert currency_graph.triangle_opportunities() == []
+
+
+def test_currency_graph_best_path(currency_graph):
+    currency_graph.update_market(1, 0.025)
+    currency_graph.update_market(2, 0.000001)
+    currency_graph.update_market(3, 0.00005)
+
+    rate, path = currency_graph.best_path("DOGE", "BTC", max_hops=1)
+    assert path == ["DOGE", "BTC"]
+    assert round(rate, 12) == 0.000001
+
+    rate, path = currency_graph.best_path("DOGE", "BTC", max_hops=2)
+    assert path == ["DOGE", "LTC", "BTC"]
+    assert round(rate, 12) == 0.00000125
+
+    assert currency_graph.best_path("XPM", "BTC") is None
+
+    # no currency is visited twice
+    rate, path = currency_graph.best_path("LTC", "BTC", max_hops=3)
+    assert path == ["LTC", "BTC"]
+    rate, path = currency_graph.best_path("BTC", "BTC", max_hops=3)
+    assert path[0] == path[-1] == "BTC"
+    assert len(set(path)) == len(path) - 1
+
+    # unknown currencies are not added to the graph
+    assert currency_graph.best_path("FOO", "BTC") is None
+    assert "FOO" not in currency_graph.adjacency
+
+
+def test_currency_graph_find_arbitrage(currency_graph):
+    currency_graph.update_market(1, 0.025)
+    currency_graph.update_market(2, 0.000001)
+    currency_graph.update_market(3, 0.00004)
+    assert currency_graph.find_arbitrage() is None
+
+    currency_graph.update_market(3, 0.00005)
+    cycle = currency_graph.find_arbitrage()
+    assert sorted(cycle) == ["BTC", "DOGE", "LTC"]
+    assert currency_graph.cycle_rate(cycle) > 1
+
+
+def test_currency_graph_find_arbitrage_without_prices(currency_graph):
+    assert CurrencyGraph([]).find_arbitrage() is None
+    assert currency_graph.find_arbitrage() is None
+
+
+@pytest.fixture
+def high_level_transport():
+    transport = Mock()
+    transport.request.return_value = \
+        '{"success": 1, "return": {"balances_available": {"LTC": "1.5"}}}'
+    return transport
+
+
+def test_raw_result_limit(high_level_transport):
+    api = HighLevelApi('KEY', 'SECRET', transport=high_level_transport,
+                       raw_result_limit=10)
+    assert api.info() == {"balances_available": {"LTC": 1.5}}
+    assert api.last_raw_result is None
+
+    api.raw_result_limit = None
+    api.info()
+    assert api.last_raw_result["success"] == 1
+
+
+def test_weak_balance_cache(high_level_transport):
+    api = HighLevelApi('KEY', 'SECRET', transport=high_level_transport,
+                       weak_cache=True)
+    balance = api.get_balance()
+    assert isinstance(balance, AccountBalance)
+    assert api.get_balance() is balance
+    assert high_level_transport.request.call_count == 1
+    del balance
+    assert api.balance is None
+
+
+def test_switch_weak_balance_cache(high_level_transport):
+    """ weak_cache may be changed after a balance is cached. """
+    api = HighLevelApi('KEY', 'SECRET', transport=high_level_transport)
+    balance = api.get_balance()
+    api.weak_cache = True
+    assert api.get_balance() is balance
+
+    api.balance = None
+    balance = api.get_balance()
+    api.weak_cache = False
+    assert api.get_balance() is balance
+
+
+def test_last_raw_result_of_cached_public_data(high_level_transport):
+    """ A cached result has no raw result. """
+    cache = PublicCache(ttl=60)
+    cache.set('http://pubapi.cryptsy.com/api.php?method=marketdatav2',
+              {'markets': {}})
+    api = HighLevelApi('KEY', 'SECRET', transport=high_level_transport,
+                       public_cache=cache)
+    api.info()
+    assert api.last_raw_result is not None
+
+    assert api.market_data(v2=True) == {'markets': {}}
+    assert api.last_method == 'marketdatav2'
+    assert api.last_raw_result is None
+    assert api.last_response_size is None
+
+
+def test_memory_usage(high_level_transport):
+    api = HighLevelApi('KEY', 'SECRET', transport=high_level_transport)
+    assert api.memory_usage()["total"] == 0
+
+    api.public_cache = PublicCache()
+    assert api.memory_usage()["public_cache"] == \
+        api.public_cache.memory_usage()
+    api.public_cache = None
+
+    api.get_balance()
+    usage = api.memory_usage()
+    assert usage["balance"] > 0
+    assert usage["last_raw_result"] > 0
+    assert usage["total"] == usage["balance"] + usage["last_raw_result"]
+
+
+@pytest.fixture
+def fee_api():
+    api = Mock()
+
+    def calculate_fees(ordertype, quantity, price):
+        total = quantity * price
+        if ordertype == 'Buy':
+            fee = total * api.buy_rate
+            return {"fee": "%.8f" % fee, "net": "%.8f" % (total + fee)}
+        fee = total * 0.003
+        return {"success": "1",
+                "return": {"fee": "%.8f" % fee, "net": "%.8f" % (total - fee)}}
+
+    api.buy_rate = 0.002
+    api.calculate_fees = Mock(side_effect=calculate_fees)
+    return api
+
+
+def test_fee_model(fee_api):
+    fee_model = FeeModel(fee_api)
+    assert fee_model.fees('Buy', [100, 10], [0.5, 2]) == [
+        (0.1, 50.1), (0.04, 20.04)
+    ]
+    assert fee_model.fee('Sell', 100, 0.5) == (0.15, 49.85)
+    assert fee_api.calculate_fees.call_count == 2
+
+    # learned schedule is used, no more API calls
+    fee_model.fees('Buy', [1] * 100, [2] * 100)
+    assert fee_api.calculate_fees.call_count == 2
+
+
+def test_fee_model_precise_rate(fee_api):
+    """ The rate must be learned precise enough for large orders, although
+    the API rounds fees to 8 decimals. """
+    fee_api.buy_rate = 0.002345678
+    fee_model = FeeModel(fee_api)
+    assert fee_model.fee('Buy', 10000, 1) == (23.45678, 10023.45678)
+
+
+def test_fee_model_observe(fee_api):
+    fee_api.buy_rate = 0.002345678
+    fee_model = FeeModel(fee_api)
+    fee_model.learn('Buy')
+
+    # a small order doesn't replace the precise rate
+    assert not fee_model.observe('Buy', 1, 1,
+                                 {"fee": "0.00234568", "net": "1.00234568"})
+    assert fee_model.schedule['Buy'] == (0.002345678, 1)
+
+    # but a changed schedule does
+    assert fee_model.observe('Buy', 1, 1,
+                             {"fee": "0.00100000", "net": "1.00100000"})
+    assert fee_model.schedule['Buy'] == (0.001, 1)
+
+    with pytest.raises(ValueError):
+        fee_model.observe('Buy', 0, 1, {"fee": "0", "net": "0"})
+
+
+def test_fee_model_check(fee_api):
+    fee_model = FeeModel(fee_api, check_interval=60)
+    fee_model.fee('Buy', 100, 0.5)
+    assert fee_model.check() == set()
+
+    assert fee_model.changed == set()
+
+    # the automatic check reports the change
+    fee_api.buy_rate = 0.001
+    fee_model.last_check -= 61
+    assert fee_model.fee('Buy', 100, 0.5) == (0.05, 50.05)
+    assert fee_model.changed == set(['Buy'])
+    fee_model.changed.clear()
+
+    assert fee_model.check() == set()
+    fee_api.buy_rate = 0.002
+    assert fee_model.check() == set(['Buy'])
+    assert fee_model.changed == set(['Buy'])